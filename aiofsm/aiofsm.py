@@ -49,44 +49,48 @@ def transition(source, target, conditions=None, on_error=None, exception=None):
         if not isinstance(on_error, allowed_types):
             raise ValueError("on_error needs to be a bool, int or string")
 
+    source_set = frozenset(source)
+    has_conditions = bool(conditions)
+    keep_state = target is None
+
     def transition_decorator(func):
         func.__fsm = Transition(func.__name__, source, target, conditions, on_error, exception)
 
-        @functools.wraps(func)
-        async def _wrapper(*args, **kwargs):
-            try:
-                self, rest = args
-            except ValueError:
-                self = args[0]
-
-            if self.state not in source:
-                exception_message = (
-                    f"Current state is {self.state}. "
+        def _enter(args, kwargs):
+            """Check the transition is allowed and return the state to set once it succeeds"""
+            state = args[0].state
+            if state not in source_set:
+                raise InvalidStartState(
+                    f"Current state is {state}. "
                     f"{func.__name__} allows transitions from {source}."
                 )
-                raise InvalidStartState(exception_message)
 
-            conditions_not_met = []
-            for condition in conditions:
-                if not condition(*args, **kwargs):
-                    conditions_not_met.append(condition)
-            if conditions_not_met:
-                raise ConditionsNotMet(conditions_not_met)
+            if has_conditions:
+                conditions_not_met = [c for c in conditions if not c(*args, **kwargs)]
+                if conditions_not_met:
+                    raise ConditionsNotMet(conditions_not_met)
 
-            new_state = target if target is not None else self.state
+            return state if keep_state else target
 
-            if not on_error:
-                result = await func(*args, **kwargs)
-                self.state = new_state
-                return result
-
-            try:
+        if on_error:
+            @functools.wraps(func)
+            async def _wrapper(*args, **kwargs):
+                new_state = _enter(args, kwargs)
+                self = args[0]
+                try:
+                    result = await func(*args, **kwargs)
+                    self.state = new_state
+                    return result
+                except exception:
+                    self.state = on_error
+                    return
+        else:
+            @functools.wraps(func)
+            async def _wrapper(*args, **kwargs):
+                new_state = _enter(args, kwargs)
                 result = await func(*args, **kwargs)
-                self.state = new_state
+                args[0].state = new_state
                 return result
-            except exception:
-                self.state = on_error
-                return
 
         return _wrapper
 
@@ -1,6 +1,6 @@
 import asyncio
+import functools
 import logging
-import math
 import time
 from enum import Enum
 
@@ -12,9 +12,12 @@ from aiofsm import StateMachine, transition
 
 from core.exceptions import ConnectionFailedTooManyTimes
 from core.updater import Updater
+from core.utils import aclosing, buffered, first
 from helpers.conversions import DEG_2_RAD, RAD_2_DEG
 from precision_landing.tracker import SingleMarkerTracker, MarkerAngles, LandingMarker
 
+logger = logging.getLogger(__name__)
+
 
 class DroneState(Enum):
     BOOTSTRAPPING = "bootstrapping"
@@ -28,21 +31,34 @@ class DroneStateMachine(StateMachine):
         self.state = DroneState.BOOTSTRAPPING
         super().__init__()
 
+    @property
+    def state(self) -> DroneState:
+        return self._state
+
+    @state.setter
+    def state(self, new_state: DroneState):
+        # The is_* flags are refreshed here, once per transition, so reading them is a plain attribute load
+        self._state = new_state
+        self._is_bootstrapping = new_state is DroneState.BOOTSTRAPPING
+        self._is_ready = new_state is DroneState.READY
+        self._is_flying = new_state is DroneState.FLYING
+        self._is_charging = new_state is DroneState.CHARGING
+
     @property
     def is_bootstrapping(self):
-        return self.state == DroneState.BOOTSTRAPPING
+        return self._is_bootstrapping
 
     @property
     def is_ready(self):
-        return self.state == DroneState.READY
+        return self._is_ready
 
     @property
     def is_flying(self):
-        return self.state == DroneState.FLYING
+        return self._is_flying
 
     @property
     def is_charging(self):
-        return self.state == DroneState.CHARGING
+        return self._is_charging
 
 
 class AsyncTaskManagerMixin:
@@ -53,18 +69,31 @@ class AsyncTaskManagerMixin:
             raise ValueError("Need to set a running_tasks: list instance variable")
 
     def add_new_bg_task(self, task):
+        # Background jobs must run concurrently, so each one keeps its own task;
+        # the finished ones are dropped to keep the list bounded across mission cycles
+        running_tasks = []
+        for t in self.running_tasks:
+            if not t.done():
+                running_tasks.append(t)
+            elif not t.cancelled() and t.exception() is not None:
+                logger.error(f"Background task {t.get_name()} failed", exc_info=t.exception())
+        self.running_tasks = running_tasks
         new_task = asyncio.ensure_future(task)
         self.running_tasks.append(new_task)
+        return new_task
 
     async def terminate_running_tasks(self):
         for task in self.running_tasks:
             task.cancel()
-            try:
-                await task
-            except asyncio.CancelledError:
-                pass
-        await asyncio.get_event_loop().shutdown_asyncgens()
-        self.running_tasks = []
+        try:
+            results = await asyncio.gather(*self.running_tasks, return_exceptions=True)
+        finally:
+            tasks, self.running_tasks = self.running_tasks, []
+
+        # Errors raised before the cancellation would be lost otherwise
+        for task, result in zip(tasks, results):
+            if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+                logger.error(f"Background task {task.get_name()} failed", exc_info=result)
 
 
 class DroneController(DroneStateMachine, AsyncTaskManagerMixin):
@@ -84,17 +113,32 @@ class DroneController(DroneStateMachine, AsyncTaskManagerMixin):
         self.is_simulation = "serial://" not in connection_address
         self.max_connection_retries = max_retries
         self.connection_attempts = 0
+        self.connection_stable_s = 0.5  # Seconds without disconnection needed to trust the link
+        self.connection_retry_delay = 0.1  # Seconds, doubled after every failed attempt
         self.running_tasks = []  # Maybe swapping the order of the mixins
 
         self.use_visual_landing = use_visual_landing
-        self.landing_marker_tracker = SingleMarkerTracker(
-            0, 14.0, show_frame=show_visual_landing, calibration_folder=calibration_folder,
+        # The tracker opens the camera, so it is only created when a visual landing starts
+        self._tracker_kwargs = dict(
+            marker_id=0,
+            marker_size=14.0,
+            show_frame=show_visual_landing,
+            calibration_folder=calibration_folder,
+            threaded_capture=True,
         )
+        self.landing_marker_tracker = None
         self.landing_frequency_input = 1  # Hertz
         self.landing_safe_altitude = 25  # Centimeters below which we enter LAND mode
         self.landing_descend_angle = 20 * DEG_2_RAD
         self.landing_descend_speed = 30.0
 
+        self._next_plan_download = None
+
+        # Latest telemetry values, kept up to date by the observers started in visual_landing
+        self._last_mission_item = 0
+        self._last_position = None
+        self._last_yaw_deg = None
+
     @transition(
         source=DroneState.BOOTSTRAPPING,
         target=DroneState.READY,
@@ -108,19 +152,36 @@ class DroneController(DroneStateMachine, AsyncTaskManagerMixin):
         await self.drone.connect(self._connection_address)
         self.logger.debug("Connected to the address. Checking state")
 
-        async for state in self.drone.core.connection_state():
-            self.logger.debug("Waiting for connection")
-
-            if state.is_connected is True:
-                self.logger.info("The system is now connected")
-                break
-
-            self.logger.debug("Failed to connect. Retrying...")
-            self.connection_attempts += 1
-
-            if self.connection_attempts > self.max_connection_retries:
-                self.logger.debug("Tried too many times to connect")
-                raise ConnectionFailedTooManyTimes(attempts=self.connection_attempts)
+        # The connection state stream only sends changes, and can flip between connected and disconnected
+        # on a healthy link: the drone is connected once no disconnection follows for connection_stable_s
+        loop = asyncio.get_running_loop()
+        async with aclosing(self.drone.core.connection_state()) as connection_states:
+            connected_since = None
+            while True:
+                timeout = None if connected_since is None else connected_since + self.connection_stable_s - loop.time()
+                try:
+                    state = await asyncio.wait_for(connection_states.__anext__(), timeout)
+                except (asyncio.TimeoutError, StopAsyncIteration):
+                    if connected_since is not None:
+                        self.logger.info("The system is now connected")
+                    break
+
+                self.logger.debug("Waiting for connection")
+
+                if state.is_connected is True:
+                    if connected_since is None:
+                        connected_since = loop.time()
+                    continue
+
+                connected_since = None
+                self.logger.debug("Failed to connect. Retrying...")
+                self.connection_attempts += 1
+
+                if self.connection_attempts > self.max_connection_retries:
+                    self.logger.debug("Tried too many times to connect")
+                    raise ConnectionFailedTooManyTimes(attempts=self.connection_attempts)
+
+                await asyncio.sleep(min(self.connection_retry_delay * 2 ** self.connection_attempts, 2.0))
 
         if not test:
             self.logger.info("Setting defaults")
@@ -137,58 +198,70 @@ class DroneController(DroneStateMachine, AsyncTaskManagerMixin):
     async def observe_charging(self):
         """Monitor the battery percentage (based on telemetry data) and waits until it is greater than 95%"""
 
+        log = self.logger
         prev_remaining_percent = None
-        async for battery in self.drone.telemetry.battery():
-            if prev_remaining_percent != battery.remaining_percent:
-                prev_remaining_percent = battery.remaining_percent
-                self.logger.debug(
-                    f"Charging... Battery is {battery.remaining_percent*100:.2f}% charged"
-                )
-
-            if battery.remaining_percent > 0.95:
-                self.logger.info("Charging complete")
-                return
+        async with aclosing(buffered(self.drone.telemetry.battery())) as battery_stream:
+            async for battery in battery_stream:
+                remaining_percent = battery.remaining_percent
+                if remaining_percent > 0.95:
+                    log.info("Charging complete")
+                    return
+
+                # Ignore telemetry noise below 0.1%
+                if prev_remaining_percent is None or abs(remaining_percent - prev_remaining_percent) >= 0.001:
+                    prev_remaining_percent = remaining_percent
+                    if log.isEnabledFor(logging.DEBUG):
+                        log.debug(f"Charging... Battery is {remaining_percent*100:.2f}% charged")
 
     @transition(source=DroneState.FLYING, target=DroneState.READY)
     async def observe_flying(self):
         """Monitors whether the drone is flying or not and returns after landing"""
         was_in_air = False
 
-        async for is_in_air in self.drone.telemetry.in_air():
-            if is_in_air:
-                was_in_air = is_in_air
+        async with aclosing(buffered(self.drone.telemetry.in_air())) as in_air_stream:
+            async for is_in_air in in_air_stream:
+                if is_in_air:
+                    was_in_air = is_in_air
 
-            if was_in_air and not is_in_air:
-                return
+                if was_in_air and not is_in_air:
+                    return
 
     async def observe_flight_mode(self):
+        log = self.logger
         prev_mode = None
-        async for mode in self.drone.telemetry.flight_mode():
-            if mode != prev_mode:
-                prev_mode = mode
-                self.logger.info(f"Flight mode {mode.name}")
+        async with aclosing(buffered(self.drone.telemetry.flight_mode())) as flight_mode_stream:
+            async for mode in flight_mode_stream:
+                if mode != prev_mode:
+                    prev_mode = mode
+                    if log.isEnabledFor(logging.INFO):
+                        log.info(f"Flight mode {mode.name}")
 
     @transition(
         source=DroneState.READY,
         target=DroneState.FLYING,
     )
     async def monitor_mission_progress(self):
-        async for mission_progress in self.drone.mission_raw.mission_progress():
-            self.logger.info(
-                f"Mission progress: {mission_progress.current}/{mission_progress.total}"
-            )
+        async with aclosing(buffered(self.drone.mission_raw.mission_progress())) as progress_stream:
+            async for mission_progress in progress_stream:
+                self.logger.info(
+                    f"Mission progress: {mission_progress.current}/{mission_progress.total}"
+                )
 
-            if self.use_visual_landing and mission_progress.current == mission_progress.total - 1:
-                await self.visual_landing()
+                if self.use_visual_landing and mission_progress.current == mission_progress.total - 1:
+                    await self.visual_landing()
 
     async def preflight_checks(self) -> bool:
-        async for health in self.drone.telemetry.health():
-            if not all(vars(health).values()):
-                failed_checks = [p for p, v in vars(health).items() if v is False]
-                self.logger.warning(f"PRE-FLIGHT checks FAILED: {failed_checks}")
-                return False
-            return True
-
+        """Check a single health sample, closing the stream right after"""
+        async with aclosing(self.drone.telemetry.health()) as health_stream:
+            try:
+                health = await health_stream.__anext__()
+            except StopAsyncIteration:
+                return True
+
+        failed_checks = [p for p, v in vars(health).items() if v is False]
+        if failed_checks:
+            self.logger.warning(f"PRE-FLIGHT checks FAILED: {failed_checks}")
+            return False
         return True
 
     @transition(
@@ -199,18 +272,34 @@ class DroneController(DroneStateMachine, AsyncTaskManagerMixin):
         """Get updates from the ground station"""
         self.logger.info("Starting updating...")
 
-        plan_path = await self.updater.download_next_mission_plan()
+        plan_path = await self._get_next_mission_plan()
         plan = await self.drone.mission_raw.import_qgroundcontrol_mission(plan_path)
         self.logger.info("Importing Mission")
-        await self.drone.mission_raw.upload_mission(plan.mission_items)
+        upload = asyncio.ensure_future(self.drone.mission_raw.upload_mission(plan.mission_items))
+        # Overlap the download of the following plan with the upload of the current one.
+        # It is a background task, so it gets cancelled with the others at shutdown
+        self._next_plan_download = self.add_new_bg_task(self.updater.download_next_mission_plan())
+        await upload
         self.logger.info("Update done")
 
+    async def _get_next_mission_plan(self) -> str:
+        """Return the plan prefetched by the previous update, downloading it if there is none"""
+        prefetched, self._next_plan_download = self._next_plan_download, None
+        # A prefetch cancelled by terminate_running_tasks is downloaded again
+        if prefetched is not None and not prefetched.cancelled():
+            try:
+                return await prefetched
+            except Exception as e:
+                self.logger.warning(f"Prefetched mission plan download failed, retrying: {e}")
+        return await self.updater.download_next_mission_plan()
+
     async def wait_for_global_position(self):
-        async for health in self.drone.telemetry.health():
-            self.logger.info("Waiting Global Estimate position")
-            if health.is_global_position_ok:
-                self.logger.info("Global Estimate position is OK, ready to start")
-                return
+        async with aclosing(buffered(self.drone.telemetry.health())) as health_stream:
+            async for health in health_stream:
+                self.logger.info("Waiting Global Estimate position")
+                if health.is_global_position_ok:
+                    self.logger.info("Global Estimate position is OK, ready to start")
+                    return
 
     @transition(source=DroneState.READY, target=DroneState.FLYING)
     async def takeoff(self):
@@ -253,15 +342,17 @@ class DroneController(DroneStateMachine, AsyncTaskManagerMixin):
     async def run(self):
         await self.bootstrap()
         self.add_new_bg_task(self.observe_flight_mode())
-        while True:
-            await self.fly()
-            await self.rest()
+        try:
+            while True:
+                await self.fly()
+                await self.rest()
+        finally:
+            await self.terminate_running_tasks()
 
     def _should_decrease_altitude(self, marker_angle: MarkerAngles):
-        return (
-            math.sqrt(marker_angle.angle_x ** 2 + marker_angle.angle_y ** 2)
-            <= self.landing_descend_angle
-        )
+        angle_x, angle_y = marker_angle
+        # Read on every call, landing_descend_angle can be changed after construction
+        return angle_x * angle_x + angle_y * angle_y <= self.landing_descend_angle * self.landing_descend_angle
 
     @staticmethod
     def _get_precise_height(current_position: Position, marker: LandingMarker) -> float:
@@ -272,88 +363,136 @@ class DroneController(DroneStateMachine, AsyncTaskManagerMixin):
         )
 
     async def get_current_position(self) -> Position:
-        async for position in self.drone.telemetry.position():
-            return position
+        return await first(self.drone.telemetry.position())
 
     async def get_current_yaw_deg(self) -> float:
-        async for attitude in self.drone.telemetry.attitude_euler():
-            return attitude.yaw_deg
+        attitude = await first(self.drone.telemetry.attitude_euler())
+        return attitude.yaw_deg if attitude is not None else None
 
     async def get_current_mission_item(self) -> int:
-        async for progress in self.drone.mission_raw.mission_progress():
-            return progress.current
+        progress = await first(self.drone.mission_raw.mission_progress())
+        return progress.current if progress is not None else None
+
+    async def observe_mission_item(self):
+        async with aclosing(buffered(self.drone.mission_raw.mission_progress())) as progress_stream:
+            async for progress in progress_stream:
+                self._last_mission_item = progress.current
+
+    async def observe_position(self):
+        async with aclosing(buffered(self.drone.telemetry.position())) as position_stream:
+            async for position in position_stream:
+                self._last_position = position
+
+    async def observe_yaw(self):
+        async with aclosing(buffered(self.drone.telemetry.attitude_euler())) as attitude_stream:
+            async for attitude in attitude_stream:
+                self._last_yaw_deg = attitude.yaw_deg
 
     async def observe_is_armed(self):  # sourcery skip: use-assigned-variable
+        log = self.logger
         prev_state = None
-        async for is_armed in self.drone.telemetry.armed():
-            if is_armed != prev_state:
-                prev_state = is_armed
-                self.logger.info(f"Is Armed? {is_armed}")
+        async with aclosing(buffered(self.drone.telemetry.armed())) as armed_stream:
+            async for is_armed in armed_stream:
+                if is_armed != prev_state:
+                    prev_state = is_armed
+                    if log.isEnabledFor(logging.INFO):
+                        log.info(f"Is Armed? {is_armed}")
 
-            if not is_armed:
-                self.use_visual_landing = False
+                if not is_armed:
+                    self.use_visual_landing = False
 
     async def visual_landing(self):
-        last_command_input = time.time()
-        should_rtl = False
-        while self.use_visual_landing:
-            current_mission_item = await self.get_current_mission_item()
-            marker = self.landing_marker_tracker.track()
-            if not marker:
-                await asyncio.sleep(0.5)
-                continue
-
-            if marker:
-                self.logger.info("Landing Marker found, pausing mission.")
-                await self.drone.mission_raw.pause_mission()
-                should_rtl = True
-
-                current_position = await self.get_current_position()
-                current_height = self._get_precise_height(current_position, marker)
-
-                if (
-                    time.time()
-                    >= last_command_input + 1.0 / self.landing_frequency_input
-                ):
-                    last_command_input = time.time()
-
-                    marker_angle = marker.estimate_angles_to_marker(current_height)
-                    self.logger.info(
-                        f"Visual Landing: {marker} -> "
-                        f"angle_x={marker_angle.angle_x * RAD_2_DEG} "
-                        f"angle_y={marker_angle.angle_y * RAD_2_DEG}"
-                    )
-
-                    yaw_deg = await self.get_current_yaw_deg()
-                    marker_lat, marker_lon = marker.get_coordinates(
-                        current_position, yaw_deg
-                    )
-                    if self._should_decrease_altitude(marker_angle):
-                        absolute_altitude_m = current_position.absolute_altitude_m - (
-                            self.landing_descend_speed
-                            * 0.01
-                            / self.landing_frequency_input
+        loop = asyncio.get_running_loop()
+        if self.landing_marker_tracker is None:
+            # Opening the camera and loading the calibration block, so they run outside the event loop
+            creation = loop.run_in_executor(None, functools.partial(SingleMarkerTracker, **self._tracker_kwargs))
+            try:
+                self.landing_marker_tracker = await asyncio.shield(creation)
+            except asyncio.CancelledError:
+                # The worker thread keeps building the tracker, it must be released once ready
+                try:
+                    tracker = await creation
+                except Exception as e:
+                    self.logger.warning(f"Landing marker tracker creation failed: {e}")
+                else:
+                    await loop.run_in_executor(None, tracker.stop)
+                raise
+
+        observers = []
+        try:
+            # Seed the telemetry cache once, then keep single streams open instead of subscribing every tick
+            self._last_mission_item, self._last_position, self._last_yaw_deg = await asyncio.gather(
+                self.get_current_mission_item(), self.get_current_position(), self.get_current_yaw_deg(),
+            )
+            observers = [
+                self.add_new_bg_task(self.observe_mission_item()),
+                self.add_new_bg_task(self.observe_position()),
+                self.add_new_bg_task(self.observe_yaw()),
+            ]
+
+            # Derived once per landing from the public settings
+            control_period = 1.0 / self.landing_frequency_input  # Seconds between two landing commands
+            alt_step = self.landing_descend_speed * 0.01 * control_period  # Meters to descend per command
+
+            last_command_input = time.monotonic()
+            should_rtl = False
+            while self.use_visual_landing:
+                current_mission_item = self._last_mission_item
+                marker = self.landing_marker_tracker.track(timeout=0)
+                if not marker:
+                    await asyncio.sleep(0.5)
+                    continue
+
+                if marker:
+                    self.logger.info("Landing Marker found, pausing mission.")
+                    await self.drone.mission_raw.pause_mission()
+                    should_rtl = True
+
+                    current_position = self._last_position
+                    current_height = self._get_precise_height(current_position, marker)
+
+                    if time.monotonic() >= last_command_input + control_period:
+                        last_command_input = time.monotonic()
+
+                        marker_angle = marker.estimate_angles_to_marker(current_height)
+                        self.logger.info(
+                            f"Visual Landing: {marker} -> "
+                            f"angle_x={marker_angle.angle_x * RAD_2_DEG} "
+                            f"angle_y={marker_angle.angle_y * RAD_2_DEG}"
+                        )
+
+                        yaw_deg = self._last_yaw_deg
+                        marker_lat, marker_lon = marker.get_coordinates(
+                            current_position, yaw_deg
                         )
-                    else:
-                        absolute_altitude_m = current_position.absolute_altitude_m
-
-                    self.logger.info(
-                        f"Commanding to go at "
-                        f"LAT={marker_lat} "
-                        f"LON={marker_lon} "
-                        f"ALT={absolute_altitude_m} "
-                        f"YAW={yaw_deg}"
-                    )
-                    await self.drone.action.goto_location(
-                        marker_lat, marker_lon, absolute_altitude_m, yaw_deg
-                    )
-
-                if current_height <= self.landing_safe_altitude:
-                    self.logger.info("Landing")
-                    await self.drone.action.land()
-            elif should_rtl:
-                await self.drone.mission_raw.set_current_mission_item(current_mission_item)
-                should_rtl = False
-
-        self.landing_marker_tracker.stop()
+                        if self._should_decrease_altitude(marker_angle):
+                            absolute_altitude_m = current_position.absolute_altitude_m - alt_step
+                        else:
+                            absolute_altitude_m = current_position.absolute_altitude_m
+
+                        self.logger.info(
+                            f"Commanding to go at "
+                            f"LAT={marker_lat} "
+                            f"LON={marker_lon} "
+                            f"ALT={absolute_altitude_m} "
+                            f"YAW={yaw_deg}"
+                        )
+                        await self.drone.action.goto_location(
+                            marker_lat, marker_lon, absolute_altitude_m, yaw_deg
+                        )
+
+                    if current_height <= self.landing_safe_altitude:
+                        self.logger.info("Landing")
+                        await self.drone.action.land()
+                elif should_rtl:
+                    await self.drone.mission_raw.set_current_mission_item(current_mission_item)
+                    should_rtl = False
+        finally:
+            # The landing usually ends by being cancelled, the camera must be released anyway
+            for observer in observers:
+                observer.cancel()
+            await asyncio.gather(*observers, return_exceptions=True)
+
+            tracker, self.landing_marker_tracker = self.landing_marker_tracker, None
+            await loop.run_in_executor(None, tracker.stop)
         self.logger.info("Landed")
\ No newline at end of file
@@ -0,0 +1,68 @@
+import asyncio
+from typing import AsyncIterator, Optional, TypeVar
+
+try:
+    from contextlib import aclosing
+except ImportError:  # Python < 3.10
+    class aclosing:
+        """Async context manager that closes an async generator on exit"""
+
+        def __init__(self, thing):
+            self.thing = thing
+
+        async def __aenter__(self):
+            return self.thing
+
+        async def __aexit__(self, exc_type, exc_val, exc_tb):
+            await self.thing.aclose()
+
+
+T = TypeVar("T")
+
+_END = object()
+
+
+async def first(source: AsyncIterator[T]) -> Optional[T]:
+    """Return the first item of an async generator, or None if it is empty, closing it right after"""
+    async with aclosing(source) as stream:
+        try:
+            return await stream.__anext__()
+        except StopAsyncIteration:
+            return None
+
+
+async def buffered(source: AsyncIterator[T], n: int = 1) -> AsyncIterator[T]:
+    """Iterate over an async iterator while a background task keeps up to n items ready.
+    It lets MAVSDK produce the next telemetry message while the consumer is still processing the current one"""
+    queue = asyncio.Queue(maxsize=n)
+
+    async def _produce():
+        try:
+            async for item in source:
+                await queue.put((item, None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put((_END, e))
+            return
+        finally:
+            aclose = getattr(source, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        await queue.put((_END, None))
+
+    producer = asyncio.ensure_future(_produce())
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        producer.cancel()
+        try:
+            await producer
+        except asyncio.CancelledError:
+            pass
@@ -1,19 +1,54 @@
 import logging
+import multiprocessing as mp
+import os
+import sys
 import time
-import glob
 import random
 import argparse
+from typing import List, Optional
+
 import numpy as np
 import cv2 as cv
 
 
+def open_video_capture(index: int = 0, frame_size: Optional[List] = None, raw_yuyv: bool = False) -> cv.VideoCapture:
+    """Open the camera requesting MJPG frames and a single frame buffer, so read() returns the freshest frame.
+    With raw_yuyv the packed YUYV frames are returned as they are, without the BGR conversion"""
+    backend = cv.CAP_V4L2 if sys.platform.startswith("linux") else cv.CAP_ANY
+    cam = cv.VideoCapture(index, backend)
+    cam.set(cv.CAP_PROP_FOURCC, cv.VideoWriter_fourcc(*("YUYV" if raw_yuyv else "MJPG")))
+    if raw_yuyv:
+        cam.set(cv.CAP_PROP_CONVERT_RGB, 0)
+    if frame_size is not None:
+        cam.set(cv.CAP_PROP_FRAME_WIDTH, frame_size[0])
+        cam.set(cv.CAP_PROP_FRAME_HEIGHT, frame_size[1])
+    cam.set(cv.CAP_PROP_BUFFERSIZE, 1)
+    cam.set(cv.CAP_PROP_FPS, 30)
+    return cam
+
+
+def _find_chessboard_corners(args):
+    """Worker for Camera.calibrate: returns the image size, whether the chessboard was found,
+    its corners and, if requested, the corners refined for display"""
+    image_filename, pattern_size, termination_criteria, refine = args
+    gray = cv.imread(image_filename, cv.IMREAD_GRAYSCALE)
+    # FAST_CHECK quickly rejects the images without a chessboard
+    flags = cv.CALIB_CB_FAST_CHECK | cv.CALIB_CB_ADAPTIVE_THRESH | cv.CALIB_CB_NORMALIZE_IMAGE
+    found, corners = cv.findChessboardCorners(gray, pattern_size, None, flags)
+
+    refined_corners = None
+    if found and refine:
+        refined_corners = cv.cornerSubPix(gray, corners.copy(), (11, 11), (-1, -1), termination_criteria)
+    return gray.shape[::-1], found, corners, refined_corners
+
+
 class Camera:
     def __init__(self, calibration_path="data/camera/calibration"):
         self.logger = logging.getLogger(__name__)
         self.calibration_folder = calibration_path
 
     def __enter__(self):
-        self.cam = cv.VideoCapture(0)
+        self.cam = open_video_capture(0)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.cam.release()
@@ -56,23 +91,36 @@ class Camera:
         real_world_points = []  # 3d point in real world space
         image_points = []  # 2d points in image plane.
 
-        images = glob.glob(f'{self.calibration_folder}/images/*.jpg')
+        with os.scandir(f'{self.calibration_folder}/images') as entries:
+            images = [
+                entry.path for entry in entries
+                if entry.name.endswith('.jpg') and not entry.name.startswith('.')
+                and entry.is_file(follow_symlinks=False)
+            ]
         image_size = None
-        for image_filename in images:
-            img = cv.imread(image_filename)
-            gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
-            image_size = gray.shape[::-1]
-            found, corners = cv.findChessboardCorners(gray, (7, 6), None)
-
-            if found:
-                real_world_points.append(chessboard_corner_points)
-                image_points.append(corners)
-
-                if display_results:
-                    corners2 = cv.cornerSubPix(gray, corners, (11, 11), (-1, -1), termination_criteria)
-                    cv.drawChessboardCorners(img, (7, 6), corners2, found)
-                    cv.imshow('img', img)
-                    cv.waitKey(500)
+        # The chessboard search is independent for every image, one OpenCV thread per worker process.
+        # Results are consumed as soon as they are ready, while the workers keep reading the next images
+        with mp.Pool(os.cpu_count(), initializer=cv.setNumThreads, initargs=(1,)) as pool:
+            results = pool.imap(
+                _find_chessboard_corners,
+                [(image_filename, (7, 6), termination_criteria, display_results) for image_filename in images],
+            )
+
+            for image_filename, (size, found, corners, refined_corners) in zip(images, results):
+                if image_size is None:
+                    image_size = size
+                elif size != image_size:
+                    raise ValueError(f"{image_filename} is {size}, while the previous images are {image_size}")
+
+                if found:
+                    real_world_points.append(chessboard_corner_points)
+                    image_points.append(corners)
+
+                    if display_results:
+                        img = cv.imread(image_filename)
+                        cv.drawChessboardCorners(img, (7, 6), refined_corners, found)
+                        cv.imshow('img', img)
+                        cv.waitKey(500)
 
         self.logger.info(f"Processed {len(images)} files. "
                          f"Found corners in {len(real_world_points)} images. "
@@ -83,8 +131,8 @@ class Camera:
         _, camera_mat, distortion_coefs, rotation_vect, translation_vect = cv.calibrateCamera(
             real_world_points, image_points, image_size, None, None)
 
-        np.savetxt(f'{self.calibration_folder}/camera_matrix.data', camera_mat)
-        np.savetxt(f'{self.calibration_folder}/camera_distortion_coef.data', distortion_coefs)
+        np.save(f'{self.calibration_folder}/camera_matrix.npy', camera_mat.astype(np.float64))
+        np.save(f'{self.calibration_folder}/camera_distortion_coef.npy', distortion_coefs.astype(np.float64))
         self.logger.info("Camera Matrix and Distortion coefficients saved")
 
         if display_results:
@@ -10,21 +10,54 @@ if __name__ == '__main__':
 import argparse
 import logging
 import math
+import os
+import queue
+import threading
 from collections import namedtuple
 from typing import List, Optional, Tuple
 
 from helpers.constants import EARTH_RADIUS
 from helpers.conversions import DEG_2_RAD, RAD_2_DEG
+from precision_landing.camera import open_video_capture
 import numpy as np
 import cv2 as cv
 import cv2.aruco as aruco
 
-DetectedMarkers = namedtuple("DetectedMarkers", ["corners", "ids"])
 UAVPosition = namedtuple("UAVPosition", ["x", "y"])
 MarkerAngles = namedtuple("MakerAngles", ["angle_x", "angle_y"])
 
+# Degrees of latitude per meter travelled north, on the spherical model
+METERS_TO_LAT_DEG = RAD_2_DEG / EARTH_RADIUS
+
+
+def _marker_to_lat_lon(
+        uav_x: float, uav_y: float, yaw_deg: float, latitude_deg: float, longitude_deg: float
+) -> Tuple[float, float]:
+    """UAV frame -> north/east rotation -> lat/lon offset, in a single call"""
+    yaw = yaw_deg * DEG_2_RAD
+    c = math.cos(yaw)
+    s = math.sin(yaw)
+
+    north = uav_x * c - uav_y * s
+    east = uav_x * s + uav_y * c
+
+    return (
+        latitude_deg + north * METERS_TO_LAT_DEG,
+        longitude_deg + east * METERS_TO_LAT_DEG / math.cos(latitude_deg * DEG_2_RAD),
+    )
+
+
+def _load_calibration_array(calibration_folder: str, name: str) -> np.ndarray:
+    try:
+        return np.load(f"{calibration_folder}/{name}.npy")
+    except FileNotFoundError:
+        # Calibrations saved before the binary format was introduced
+        return np.loadtxt(f"{calibration_folder}/{name}.data")
+
 
 class LandingMarker:
+    __slots__ = ("x", "y", "z", "rotations", "translations", "_uav_x", "_uav_y")
+
     def __init__(self, x: float, y: float, z: float, rotations: np.ndarray, translations: np.ndarray):
         self.x = x
         self.y = y
@@ -33,6 +66,10 @@ class LandingMarker:
         self.rotations = rotations
         self.translations = translations
 
+        # Position in the UAV frame, see convert_reference_from_camera_to_uav
+        self._uav_x = -x
+        self._uav_y = -y
+
     def convert_reference_from_camera_to_uav(self) -> UAVPosition:
         """
         Convert the reference frame from camera to UAV.
@@ -42,7 +79,7 @@ class LandingMarker:
         """
 
         # return UAVPosition(-self.y, self.x)
-        return UAVPosition(-self.x, -self.y)
+        return UAVPosition(self._uav_x, self._uav_y)
 
     def estimate_angles_to_marker(self, uav_height: Optional[float] = None) -> MarkerAngles:
         """
@@ -58,21 +95,18 @@ class LandingMarker:
         else:
             z = self.z
 
-        uav_position = self.convert_reference_from_camera_to_uav()
-
-        angle_x = math.atan2(uav_position.x, z)
-        angle_y = math.atan2(uav_position.y, z)
+        angle_x = math.atan2(self._uav_x, z)
+        angle_y = math.atan2(self._uav_y, z)
 
         return MarkerAngles(angle_x, angle_y)
 
     def get_north_east_directions_for_uav(self, current_yaw: float) -> Tuple[float, float]:
-        c = math.cos(current_yaw * DEG_2_RAD)
-        s = math.sin(current_yaw * DEG_2_RAD)
-
-        uav_position = self.convert_reference_from_camera_to_uav()
+        yaw = current_yaw * DEG_2_RAD
+        c = math.cos(yaw)
+        s = math.sin(yaw)
 
-        north = uav_position.x * c - uav_position.y * s
-        east = uav_position.x * s + uav_position.y * c
+        north = self._uav_x * c - self._uav_y * s
+        east = self._uav_x * s + self._uav_y * c
 
         return north, east
 
@@ -84,14 +118,9 @@ class LandingMarker:
             For more information see:
             http://gis.stackexchange.com/questions/2951/algorithm-for-offsetting-a-latitude-longitude-by-some-amount-of-meters
        """
-        north, east = self.get_north_east_directions_for_uav(current_yaw)
-        latitude_offset = north / EARTH_RADIUS
-        longitude_offset = east / (EARTH_RADIUS * math.cos(original_position.latitude_deg * DEG_2_RAD))
-
-        new_latitude_deg = original_position.latitude_deg + (latitude_offset * RAD_2_DEG)
-        new_longitude_deg = original_position.longitude_deg + (longitude_offset * RAD_2_DEG)
-
-        return new_latitude_deg, new_longitude_deg
+        return _marker_to_lat_lon(
+            self._uav_x, self._uav_y, current_yaw, original_position.latitude_deg, original_position.longitude_deg
+        )
 
     def __str__(self):
         return f"LandingMarker(x={self.x}, y={self.y}, z={self.z})"
@@ -105,82 +134,240 @@ class SingleMarkerTracker:
             camera_size: Optional[List] = None,
             calibration_folder: str = "data/camera/calibration",
             show_frame: bool = False,
-            debug: bool = False
+            debug: bool = False,
+            threaded_capture: bool = False,
+            yuyv_capture: bool = False,
             ):
 
         self.logger = logging.getLogger(__name__)
         self.marker_id = marker_id
         self.marker_size = marker_size
+        # Marker corners in the marker frame, in the order expected by SOLVEPNP_IPPE_SQUARE
+        half_size = marker_size / 2
+        self._marker_points = np.array([
+            [-half_size, half_size, 0],
+            [half_size, half_size, 0],
+            [half_size, -half_size, 0],
+            [-half_size, -half_size, 0],
+        ], dtype=np.float32)
 
         try:
-            self._camera_matrix = np.loadtxt(f"{calibration_folder}/camera_matrix.data")
-            self._camera_distortion = np.loadtxt(f"{calibration_folder}/camera_distortion_coef.data")
+            self._camera_matrix = _load_calibration_array(calibration_folder, "camera_matrix")
+            self._camera_distortion = _load_calibration_array(calibration_folder, "camera_distortion_coef")
         except OSError as e:
             self.logger.error(f"Cannot load a configuration, {e}")
             raise OSError(f"Cannot load a configuration, {e}")
 
         self.logger.info("Read camera matrix and distortion")
 
+        # Cast once to the layout OpenCV works on, instead of converting on every frame
+        self._camera_matrix = np.ascontiguousarray(self._camera_matrix, dtype=np.float64)
+        self._camera_distortion = np.ascontiguousarray(self._camera_distortion.reshape(1, -1), dtype=np.float64)
+
         self._stop = False
         self._debug = debug
         self._show = show_frame
 
-        self._aruco_dict = aruco.Dictionary_get(aruco.DICT_4X4_250)
-        self._parameters = aruco.DetectorParameters_create()
+        self._aruco_dict = aruco.getPredefinedDictionary(aruco.DICT_4X4_250)
+        has_detector_class = hasattr(aruco, "ArucoDetector")  # OpenCV >= 4.7
+        self._parameters = aruco.DetectorParameters() if has_detector_class else aruco.DetectorParameters_create()
+
+        if hasattr(self._parameters, "useAruco3Detection"):  # OpenCV >= 4.6
+            # Aruco3 detects on a downscaled image, sized so that markers down to ~20px wide are still found.
+            # Older versions, such as 4.5, do not have it and keep the regular full resolution detection
+            self._parameters.useAruco3Detection = True
+            self._parameters.minSideLengthCanonicalImg = 16
+            self._parameters.minMarkerLengthRatioOriginalImg = 0.01
+        # Raw corners are accurate enough for the landing pose estimation
+        self._parameters.cornerRefinementMethod = aruco.CORNER_REFINE_NONE
+
+        self._detector = aruco.ArucoDetector(self._aruco_dict, self._parameters) if has_detector_class else None
+
+        # Region (x, y, width, height) around the last detected marker, searched first on the next frame
+        self._last_bbox: Optional[Tuple[int, int, int, int]] = None
 
         camera_size = [640, 480] if camera_size is None else camera_size
-        self._cam = cv.VideoCapture(0)
-        self._cam.set(cv.CAP_PROP_FRAME_WIDTH, camera_size[0])
-        self._cam.set(cv.CAP_PROP_FRAME_HEIGHT, camera_size[1])
-
-    def _get_landing_marker(self, corners) -> LandingMarker:
-        # rotation: Array of Arrays -> attitude of the marker respect to camera frame
-        # translation: Array of Arrays -> position of the marker in camera frame
-        rotations, translations, _ = aruco.estimatePoseSingleMarkers(
-            corners, self.marker_size, self._camera_matrix, self._camera_distortion
+        self._cam = open_video_capture(0, camera_size, raw_yuyv=yuyv_capture)
+        self._yuyv_capture = yuyv_capture
+        if yuyv_capture:
+            self._frame_width = int(self._cam.get(cv.CAP_PROP_FRAME_WIDTH))
+            self._frame_height = int(self._cam.get(cv.CAP_PROP_FRAME_HEIGHT))
+            fourcc = int(self._cam.get(cv.CAP_PROP_FOURCC)).to_bytes(4, "little").decode("ascii", "replace")
+            if fourcc != "YUYV" or not self._frame_width or not self._frame_height:
+                # Raw frames of any other format cannot be read as packed YUYV, let OpenCV decode them to BGR
+                self.logger.warning(f"The camera does not provide YUYV frames ({fourcc!r}), converting from BGR")
+                self._cam.set(cv.CAP_PROP_CONVERT_RGB, 1)
+                self._yuyv_capture = False
+
+        # Grayscale image reused by every frame, resized only if the camera delivers another size
+        self._gray_buf = np.empty((camera_size[1], camera_size[0]), dtype=np.uint8)
+
+        # With threaded capture, camera reads and window updates run in their own threads
+        # while detection stays on the caller's thread
+        self._frames = None
+        self._display_frames = None
+        self._threads = []
+        self._previous_num_threads = None
+        if threaded_capture:
+            # Leave a core to the reader thread. The setting is process-wide, stop() restores it
+            self._previous_num_threads = cv.getNumThreads()
+            cv.setNumThreads(max(1, (os.cpu_count() or 2) - 1))
+            self._frames = queue.Queue(maxsize=2)
+            self._threads.append(threading.Thread(target=self._read_frames, daemon=True))
+            if self._show:
+                self._display_frames = queue.Queue(maxsize=2)
+                self._threads.append(threading.Thread(target=self._display_loop, daemon=True))
+            for thread in self._threads:
+                thread.start()
+
+    @staticmethod
+    def _put_latest(frames: queue.Queue, frame) -> None:
+        """Enqueue the frame, dropping the oldest one when the consumer is behind"""
+        try:
+            frames.put_nowait(frame)
+        except queue.Full:
+            try:
+                frames.get_nowait()
+            except queue.Empty:
+                pass
+            frames.put_nowait(frame)
+
+    def _read_frames(self) -> None:
+        while not self._stop:
+            found, frame = self._cam.read()
+            if not found:
+                time.sleep(0.01)
+                continue
+            self._put_latest(self._frames, frame)
+
+    def _display_loop(self) -> None:
+        while not self._stop:
+            try:
+                frame = self._display_frames.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            cv.imshow('Camera', frame)
+            cv.waitKey(5)
+        cv.destroyAllWindows()
+
+    def _get_landing_marker(self, corners) -> Optional[LandingMarker]:
+        # rotation: attitude of the marker respect to camera frame
+        # translation: position of the marker in camera frame
+        solved, rotations, translations = cv.solvePnP(
+            self._marker_points,
+            corners.reshape(-1, 2),
+            self._camera_matrix,
+            self._camera_distortion,
+            flags=cv.SOLVEPNP_IPPE_SQUARE,
         )
+        if not solved:
+            # No usable pose, handled as if the marker was not found
+            return None
 
-        # We are dealing just with the first marker
-        rotations, translations = rotations[0, 0, :], translations[0, 0, :]
-        x, y, z = translations
+        rotations, translations = rotations.ravel(), translations.ravel()
+        # Python floats, the per-frame scalar math is done with the math module
+        x, y, z = translations.tolist()
         return LandingMarker(x, y, z, rotations, translations)
 
     def _show_detected_marker(self, frame, corners, marker) -> None:
-        aruco.drawDetectedMarkers(frame, corners)
-        aruco.drawAxis(frame, self._camera_matrix, self._camera_distortion, marker.rotations, marker.translations, 10)
+        aruco.drawDetectedMarkers(frame, (corners,))
+        # aruco.drawAxis was removed in OpenCV 4.7, drawFrameAxes exists in every supported version
+        cv.drawFrameAxes(frame, self._camera_matrix, self._camera_distortion, marker.rotations, marker.translations, 10)
 
     def stop(self):
         self._stop = True
+        for thread in self._threads:
+            thread.join()
         self._cam.release()
+        if self._previous_num_threads is not None:
+            cv.setNumThreads(self._previous_num_threads)
+            self._previous_num_threads = None
 
-        if self._show:
+        if self._show and self._display_frames is None:
             cv.destroyAllWindows()
 
-    def _detect_markers(self, gray_image) -> DetectedMarkers:
-        corners, ids, _ = aruco.detectMarkers(
-            image=gray_image,
-            dictionary=self._aruco_dict,
-            parameters=self._parameters,
-            cameraMatrix=self._camera_matrix,
-            distCoeff=self._camera_distortion
-        )
-        ids_found = ids.flatten() if ids is not None else None
-        return DetectedMarkers(corners, ids_found)
-
-    def is_landing_marker_found(self, markers: DetectedMarkers) -> bool:
-        return markers.ids is not None and self.marker_id == markers.ids[0]
-
-    def track(self) -> Optional[LandingMarker]:
-        _, frame = self._cam.read()
-        gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
-
-        detected_markers = self._detect_markers(gray)
+    def _detect_markers(self, gray_image) -> Optional[np.ndarray]:
+        """Corners of the first detected marker if it is the landing marker, None otherwise"""
+        if self._detector is not None:
+            corners, ids, _ = self._detector.detectMarkers(gray_image)
+        else:
+            corners, ids, _ = aruco.detectMarkers(
+                image=gray_image,
+                dictionary=self._aruco_dict,
+                parameters=self._parameters,
+            )
+        # We are dealing just with the first marker
+        if ids is None or int(ids[0, 0]) != self.marker_id:
+            return None
+        return corners[0]
+
+    @staticmethod
+    def _get_search_region(corners, image_shape, padding: float = 2.0, min_side: int = 64) -> Tuple[int, int, int, int]:
+        """Square region centered on the marker, padding times its size, clipped to the image"""
+        points = corners.reshape(-1, 2)
+        (min_x, min_y), (max_x, max_y) = points.min(axis=0), points.max(axis=0)
+        side = max(max_x - min_x, max_y - min_y) * padding
+        half_side = max(side, min_side) / 2
+        center_x, center_y = (min_x + max_x) / 2, (min_y + max_y) / 2
+
+        height, width = image_shape[:2]
+        x0, y0 = max(int(center_x - half_side), 0), max(int(center_y - half_side), 0)
+        x1, y1 = min(int(center_x + half_side) + 1, width), min(int(center_y + half_side) + 1, height)
+        return x0, y0, x1 - x0, y1 - y0
+
+    def _detect_landing_marker(self, gray_image) -> Optional[np.ndarray]:
+        """Look for the marker around its last position first, then in the whole frame"""
+        if self._last_bbox is not None:
+            x, y, w, h = self._last_bbox
+            corners = self._detect_markers(gray_image[y:y + h, x:x + w])
+            if corners is not None:
+                corners += np.array([x, y], dtype=np.float32)
+                self._last_bbox = self._get_search_region(corners, gray_image.shape)
+                return corners
+
+        corners = self._detect_markers(gray_image)
+        self._last_bbox = None if corners is None else self._get_search_region(corners, gray_image.shape)
+        return corners
+
+    def _as_yuyv(self, frame) -> np.ndarray:
+        return frame.reshape(self._frame_height, self._frame_width, 2)
+
+    def _to_gray(self, frame) -> np.ndarray:
+        if self._yuyv_capture:
+            frame = self._as_yuyv(frame)
+        if self._gray_buf.shape != frame.shape[:2]:
+            self._gray_buf = np.empty(frame.shape[:2], dtype=np.uint8)
+
+        if self._yuyv_capture:
+            # The Y plane of a packed YUYV frame is already the grayscale image
+            np.copyto(self._gray_buf, frame[:, :, 0])
+        else:
+            cv.cvtColor(frame, cv.COLOR_BGR2GRAY, dst=self._gray_buf)
+        return self._gray_buf
+
+    def track(self, timeout: float = 0.0) -> Optional[LandingMarker]:
+        """With threaded capture, wait up to timeout seconds for a new frame. The default never blocks,
+        as needed when track() is called from the event loop"""
+        if self._frames is None:
+            _, frame = self._cam.read()
+        else:
+            try:
+                frame = self._frames.get(timeout=timeout) if timeout > 0 else self._frames.get_nowait()
+            except queue.Empty:
+                self.logger.debug("No new frame from the camera")
+                return None
+        gray = self._to_gray(frame)
+        if self._show and self._yuyv_capture:
+            frame = cv.cvtColor(self._as_yuyv(frame), cv.COLOR_YUV2BGR_YUYV)
+
+        corners = self._detect_landing_marker(gray)
         marker = None
-        if self.is_landing_marker_found(detected_markers):
-            marker = self._get_landing_marker(detected_markers.corners)
+        if corners is not None:
+            marker = self._get_landing_marker(corners)
 
+        if marker is not None:
             if self._show:
-                self._show_detected_marker(frame, detected_markers.corners, marker)
+                self._show_detected_marker(frame, corners, marker)
 
             if self._debug:
                 # self.logger.info(f"MARKER Position x={marker.x:.4f} y={marker.y:.4f} z={marker.z:.4f}")
@@ -191,8 +378,11 @@ class SingleMarkerTracker:
                 self.logger.info("Nothing detected.")
 
         if self._show:
-            cv.imshow('Camera', frame)
-            cv.waitKey(5)
+            if self._display_frames is None:
+                cv.imshow('Camera', frame)
+                cv.waitKey(5)
+            else:
+                self._put_latest(self._display_frames, frame)
 
         return marker
 
@@ -211,9 +401,9 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    finder = SingleMarkerTracker(0, 14.0, show_frame=bool(args.display), debug=True)
+    finder = SingleMarkerTracker(0, 14.0, show_frame=bool(args.display), debug=True, threaded_capture=True)
     try:
         while True:
-            finder.track()
+            finder.track(timeout=1.0)
     except KeyboardInterrupt:
         finder.stop()
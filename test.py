@@ -7,16 +7,6 @@ from mavsdk import System
 logFormatter = " %(asctime)s %(name)s - %(levelname)s: %(message)s"
 logging.basicConfig(level=logging.DEBUG, format=logFormatter)
 
-parser = argparse.ArgumentParser(description="Control the drone")
-parser.add_argument(
-    "--takeoff",
-    dest="takeoff",
-    action="store_true",
-    help="Run the test procedure for uploading the mission",
-)
-args = parser.parse_args()
-
-
 async def test_takeoff():
     # Init the drone
     drone = System()
@@ -63,10 +53,10 @@ async def print_altitude(drone):
     previous_altitude = None
 
     async for position in drone.telemetry.position():
-        altitude = round(position.relative_altitude_m)
-        if altitude != previous_altitude:
+        altitude = position.relative_altitude_m
+        if previous_altitude is None or abs(altitude - previous_altitude) >= 1.0:
             previous_altitude = altitude
-            print(f"Altitude: {altitude}")
+            print(f"Altitude: {round(altitude)}")
 
 
 async def print_flight_mode(drone):
@@ -101,11 +91,19 @@ async def observe_is_in_air(drone, running_tasks):
             return
 
 
-async def run():
+async def run(args):
     if args.takeoff:
         await test_takeoff()
 
 
 if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(run())
+    parser = argparse.ArgumentParser(description="Control the drone")
+    parser.add_argument(
+        "--takeoff",
+        dest="takeoff",
+        action="store_true",
+        help="Run the test procedure for uploading the mission",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
@@ -6,20 +6,22 @@ from precision_landing.tracker import SingleMarkerTracker
 
 @pytest.fixture
 def mocked_core():
+    class State:
+        def __init__(self, is_connected):
+            self.is_connected = is_connected
+
+    disconnected, connected = State(False), State(True)
+
     class MockedCore:
         def __init__(self, system):
             self.system = system
 
         async def connection_state(self, *args, **kwargs):
-            class State:
-                def __init__(self, is_connected):
-                    self.is_connected = is_connected
-
             for attempt in range(10):
                 if attempt > 2:
                     self.system.tasks_done.append("connection_state_ok")
 
-                yield State(attempt > 2)
+                yield connected if attempt > 2 else disconnected
 
     return MockedCore
 
@@ -47,15 +49,19 @@ def mocked_action():
 
 @pytest.fixture
 def mocked_mission_raw():
+    class Plan:
+        mission_items = None
+
+    class MissionProgress:
+        current = 0
+        total = 0
+
     class MissionRaw:
 
         def __init__(self, system):
             self.system = system
 
         async def import_qgroundcontrol_mission(self, *args, **kwargs):
-            class Plan:
-                mission_items = None
-
             self.system.tasks_done.append("import_qgroundcontrol_mission_ok")
             return Plan()
 
@@ -63,12 +69,10 @@ def mocked_mission_raw():
             self.system.tasks_done.append("upload_mission_ok")
 
         async def mission_progress(self, *args, **kwargs):
-            class MissionProgress:
-                current = 0
-                total = 0
             self.system.tasks_done.append("mission_progress_ok")
+            progress = MissionProgress()
             for x in range(3):
-                yield MissionProgress()
+                yield progress
 
         async def start_mission(self, *args, **kwargs):
             self.system.tasks_done.append("start_mission_ok")
@@ -89,26 +93,46 @@ async def mocked_health_not_ok():
             self.is_home_position_ok = False
 
     async def health(*args, **kwargs):
+        health_sample = Health()
         for x in range(3):
-            yield Health()
+            yield health_sample
 
     return health
 
 
 @pytest.fixture
 def mocked_telemetry():
+    class Battery:
+        def __init__(self, p):
+            self.remaining_percent = float(p)
+
+    class Health:
+        def __init__(self):
+            self.is_gyrometer_calibration_ok = True
+            self.s_accelerometer_calibration_ok = True
+            self.is_magnetometer_calibration_ok = True
+            self.is_level_calibration_ok = True
+            self.is_local_position_ok = True
+            self.is_global_position_ok = True
+            self.is_home_position_ok = True
+
+    class FlightMode:
+        def __init__(self):
+            self.name = "STAB"
+
+    # The samples are built once, the controller only reads them
+    battery_samples = [Battery(percentage / 100) for percentage in range(0, 100, 5)]
+    health_sample = Health()
+    flight_mode_sample = FlightMode()
+
     class Telemetry:
         def __init__(self, system):
             self.system = system
 
         async def battery(self, *args, **kwargs):
-            class Battery:
-                def __init__(self, p):
-                    self.remaining_percent = float(p)
-
             self.system.tasks_done.append("battery_ok")
-            for percentage in range(0, 100, 5):
-                yield Battery(percentage / 100)
+            for battery in battery_samples:
+                yield battery
 
         async def in_air(self, *args, **kwargs):
             """ sequence of False, True, False. Distribution: 10%, 40%, 50%  """
@@ -117,28 +141,14 @@ def mocked_telemetry():
                 yield False if x < 10 or x > 50 else True
 
         async def health(self, *args, **kwargs):
-            class Health:
-                def __init__(self):
-                    self.is_gyrometer_calibration_ok = True
-                    self.s_accelerometer_calibration_ok = True
-                    self.is_magnetometer_calibration_ok = True
-                    self.is_level_calibration_ok = True
-                    self.is_local_position_ok = True
-                    self.is_global_position_ok = True
-                    self.is_home_position_ok = True
-
             self.system.tasks_done.append("health_ok")
             for x in range(3):
-                yield Health()
+                yield health_sample
 
         async def flight_mode(self, *args, **kwargs):
-            class FlightMode:
-                def __init__(self):
-                    self.name = "STAB"
-
             self.system.tasks_done.append("flight_mode_ok")
             for percentage in range(3):
-                yield FlightMode()
+                yield flight_mode_sample
 
     return Telemetry
 
@@ -164,22 +174,63 @@ def mocked_system(mocked_core, mocked_action, mocked_mission_raw, mocked_telemet
 @pytest.fixture
 def drone_controller(monkeypatch, mocked_system):
     c = DroneController(connection_address="test_address", calibration_folder="../data/camera/test")
+    c.connection_retry_delay = 0
     monkeypatch.setattr(c, "drone", mocked_system)
     return c
 
 
 # ========================= TRACKER =============================
 
+@pytest.fixture(scope="session")
+def session_tracker():
+    """A single tracker for the whole session, the tests swap its camera with monkeypatch"""
+    t = SingleMarkerTracker(0, 14.0, calibration_folder="../data/camera/test", debug=False)
+    yield t
+    t.stop()
+
+
 @pytest.fixture
-def mocked_cam():
-    class Cam:
-        def __init__(self, filename):
-            self.filename = filename
+def tracker(session_tracker):
+    """The session tracker, without the search region left by the previous test"""
+    session_tracker._last_bbox = None
+    return session_tracker
 
-        def read(self):
-            return True, cv.imread(filename=self.filename)
 
-        def release(self):
-            pass
+@pytest.fixture(scope="session")
+def image_cache():
+    """Test images by filename, each one decoded on first use only"""
+    class ImageCache(dict):
+        def __missing__(self, filename):
+            image = self[filename] = cv.imread(filename=filename)
+            return image
+
+    return ImageCache()
+
+
+class _FakeCam:
+    """Camera returning always the same frame"""
+    __slots__ = ("frame",)
+
+    def __init__(self, frame):
+        self.frame = frame
+
+    def read(self):
+        # Without show_frame the tracker never draws on the frame, the cached image can be shared
+        return True, self.frame
 
-    return Cam
+    def release(self):
+        pass
+
+
+@pytest.fixture
+def mocked_cam(image_cache):
+    def _mocked_cam(filename):
+        return _FakeCam(image_cache[filename])
+
+    return _mocked_cam
+
+
+@pytest.fixture
+def frame_cam():
+    """Fake camera serving a frame built by the test"""
+    return _FakeCam
@@ -0,0 +1,23 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+from precision_landing.camera import Camera
+
+
+def _chessboard(square: int) -> np.ndarray:
+    """White-bordered 8x7 squares chessboard, with the 7x6 inner corners used by the calibration"""
+    board = np.kron((np.indices((7, 8)).sum(axis=0) % 2) * 255, np.ones((square, square))).astype(np.uint8)
+    return cv.copyMakeBorder(board, square, square, square, square, cv.BORDER_CONSTANT, value=255)
+
+
+def test_calibrate_mixed_resolutions(tmp_path):
+    """
+        Calibration images of different sizes should be rejected
+    """
+    (tmp_path / "images").mkdir()
+    cv.imwrite(str(tmp_path / "images" / "1.jpg"), _chessboard(20))
+    cv.imwrite(str(tmp_path / "images" / "2.jpg"), _chessboard(30))
+
+    with pytest.raises(ValueError, match="while the previous images are"):
+        Camera(str(tmp_path)).calibrate()
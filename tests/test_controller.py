@@ -1,9 +1,11 @@
 import asyncio
+import time
 
 import pytest
 
 from aiofsm.exceptions import InvalidStartState
-from core.controller import DroneController, DroneStateMachine, DroneState
+from core.controller import AsyncTaskManagerMixin, DroneController, DroneStateMachine, DroneState
+from precision_landing.tracker import MarkerAngles
 
 
 def test_drone_state_machine():
@@ -49,13 +51,31 @@ async def test_bootstrap_ok(drone_controller: DroneController):
     assert drone_controller.drone.tasks_done == [
         # Init
         "connect_ok",
-        "connection_state_ok",
+        # Every connected sample sent before the end of the stream
+        *["connection_state_ok"] * 7,
         # Update
         "import_qgroundcontrol_mission_ok",
         "upload_mission_ok"
     ]
 
 
+@pytest.mark.asyncio
+async def test_bootstrap_single_connected_update(drone_controller: DroneController, monkeypatch):
+    class State:
+        is_connected = True
+
+    async def connection_state(*args, **kwargs):
+        # A healthy link reports the connection once, then sends nothing more
+        yield State()
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(drone_controller.drone.core, "connection_state", connection_state)
+    drone_controller.connection_stable_s = 0.05
+
+    await asyncio.wait_for(drone_controller.bootstrap(), 1.0)
+    assert drone_controller.is_ready
+
+
 @pytest.mark.asyncio
 async def test_bootstrap_max_retries_low(drone_controller: DroneController):
     # The connection state will yield True after 2 connection attempts
@@ -139,6 +159,54 @@ async def test_add_new_task(drone_controller: DroneController):
     await fake_task()
 
 
+@pytest.mark.asyncio
+async def test_add_new_task_drops_finished_tasks(drone_controller: DroneController):
+    async def fake_task():
+        pass
+
+    drone_controller.add_new_bg_task(fake_task())
+    await asyncio.sleep(0)
+    drone_controller.add_new_bg_task(fake_task())
+    assert len(drone_controller.running_tasks) == 1
+
+    await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_add_new_task_logs_failed_tasks(drone_controller: DroneController, caplog):
+    async def failing_task():
+        raise ValueError("task failed")
+
+    drone_controller.add_new_bg_task(failing_task())
+    await asyncio.sleep(0)
+    drone_controller.add_new_bg_task(asyncio.sleep(0))
+
+    assert len(drone_controller.running_tasks) == 1
+    assert any(record.exc_info and record.exc_info[0] is ValueError for record in caplog.records)
+
+    await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_task_manager_without_logger(caplog):
+    class TaskManager(AsyncTaskManagerMixin):
+        def __init__(self):
+            self.running_tasks = []
+            super().__init__()
+
+    async def failing_task():
+        raise ValueError("task failed")
+
+    manager = TaskManager()
+    manager.add_new_bg_task(failing_task())
+    await asyncio.sleep(0)
+    manager.add_new_bg_task(failing_task())
+    await asyncio.sleep(0)
+    await manager.terminate_running_tasks()
+
+    assert sum(1 for record in caplog.records if record.exc_info and record.exc_info[0] is ValueError) == 2
+
+
 @pytest.mark.asyncio
 async def test_terminate_running_tasks(drone_controller: DroneController):
     async def fake_long_task():
@@ -153,6 +221,19 @@ async def test_terminate_running_tasks(drone_controller: DroneController):
     assert len(drone_controller.running_tasks) == 0
 
 
+@pytest.mark.asyncio
+async def test_terminate_running_tasks_logs_failed_tasks(drone_controller: DroneController, caplog):
+    async def failing_task():
+        raise ValueError("task failed")
+
+    drone_controller.add_new_bg_task(failing_task())
+    await asyncio.sleep(0)
+
+    await drone_controller.terminate_running_tasks()
+    assert drone_controller.running_tasks == []
+    assert any(record.exc_info and record.exc_info[0] is ValueError for record in caplog.records)
+
+
 @pytest.mark.asyncio
 async def test_monitor_mission_progress(drone_controller: DroneController):
     drone_controller.state = DroneState.READY
@@ -187,6 +268,50 @@ async def test_update(drone_controller: DroneController):
     ]
 
 
+@pytest.mark.asyncio
+async def test_update_from_any_source_state(drone_controller: DroneController):
+    for state in [DroneState.BOOTSTRAPPING, DroneState.READY, DroneState.CHARGING]:
+        drone_controller.state = state
+        await drone_controller.update()
+        assert drone_controller.state == state
+
+
+@pytest.mark.asyncio
+async def test_update_after_prefetch_cancelled(drone_controller: DroneController, monkeypatch):
+    downloads = []
+    release_download = asyncio.Event()
+
+    async def download_next_mission_plan():
+        downloads.append(len(downloads))
+        # Only the first download completes right away, the prefetch waits until released
+        if len(downloads) > 1:
+            await release_download.wait()
+        return "data/missions/mission.plan"
+
+    monkeypatch.setattr(drone_controller.updater, "download_next_mission_plan", download_next_mission_plan)
+
+    await drone_controller.update()
+    prefetch = drone_controller._next_plan_download
+    assert prefetch in drone_controller.running_tasks
+    assert not prefetch.done()
+
+    await drone_controller.terminate_running_tasks()
+    assert prefetch.cancelled()
+
+    release_download.set()
+    await drone_controller.update()
+
+    # First plan, cancelled prefetch, download again, prefetch of the following plan
+    assert len(downloads) == 4
+    assert drone_controller.drone.tasks_done == [
+        "import_qgroundcontrol_mission_ok",
+        "upload_mission_ok",
+        "import_qgroundcontrol_mission_ok",
+        "upload_mission_ok",
+    ]
+    await drone_controller.terminate_running_tasks()
+
+
 @pytest.mark.asyncio
 async def test_update_from_wrong_state(drone_controller: DroneController):
     drone_controller.state = DroneState.FLYING
@@ -241,3 +366,69 @@ async def test_fly_from_wrong_state(drone_controller: DroneController):
     assert drone_controller.is_bootstrapping
 
 
+@pytest.mark.asyncio
+async def test_visual_landing_stops_tracker_when_cancelled(drone_controller: DroneController, monkeypatch):
+    class Tracker:
+        stopped = False
+
+        def __init__(self, **kwargs):
+            pass
+
+        def track(self, timeout=0.0):
+            return None
+
+        def stop(self):
+            Tracker.stopped = True
+
+    async def no_telemetry():
+        return None
+
+    monkeypatch.setattr("core.controller.SingleMarkerTracker", Tracker)
+    monkeypatch.setattr(drone_controller, "get_current_position", no_telemetry)
+    monkeypatch.setattr(drone_controller, "get_current_yaw_deg", no_telemetry)
+    monkeypatch.setattr(drone_controller, "observe_position", no_telemetry)
+    monkeypatch.setattr(drone_controller, "observe_yaw", no_telemetry)
+    drone_controller.use_visual_landing = True
+
+    landing = drone_controller.add_new_bg_task(drone_controller.visual_landing())
+    await asyncio.sleep(0.1)
+    assert isinstance(drone_controller.landing_marker_tracker, Tracker)
+
+    await drone_controller.terminate_running_tasks()
+    assert landing.cancelled()
+    assert Tracker.stopped
+    assert drone_controller.landing_marker_tracker is None
+
+
+@pytest.mark.asyncio
+async def test_visual_landing_stops_tracker_cancelled_during_creation(drone_controller: DroneController, monkeypatch):
+    class Tracker:
+        stopped = False
+
+        def __init__(self, **kwargs):
+            # Opening the camera takes a while
+            time.sleep(0.2)
+
+        def stop(self):
+            Tracker.stopped = True
+
+    monkeypatch.setattr("core.controller.SingleMarkerTracker", Tracker)
+    drone_controller.use_visual_landing = True
+
+    landing = drone_controller.add_new_bg_task(drone_controller.visual_landing())
+    await asyncio.sleep(0.05)
+    await drone_controller.terminate_running_tasks()
+
+    assert landing.cancelled()
+    assert Tracker.stopped
+    assert drone_controller.landing_marker_tracker is None
+
+
+def test_should_decrease_altitude(drone_controller: DroneController):
+    limit = drone_controller.landing_descend_angle
+    assert drone_controller._should_decrease_altitude(MarkerAngles(0.0, 0.0))
+    assert drone_controller._should_decrease_altitude(MarkerAngles(limit * 0.6, limit * 0.6))
+    assert not drone_controller._should_decrease_altitude(MarkerAngles(limit * 0.8, limit * 0.8))
+
+    drone_controller.landing_descend_angle = limit * 2
+    assert drone_controller._should_decrease_altitude(MarkerAngles(limit * 0.8, limit * 0.8))
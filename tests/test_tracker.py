@@ -1,11 +1,17 @@
 import math
 
+import cv2 as cv
 import numpy as np
 import pytest
+from pytest import approx
 from mavsdk.telemetry import Position
 
 from precision_landing.tracker import SingleMarkerTracker, LandingMarker, MarkerAngles
 
+# Shared by the LandingMarker tests, read-only so that no test can alter it for the others
+_ZERO1 = np.zeros(1)
+_ZERO1.setflags(write=False)
+
 
 def test_tracker_non_existing_configuration():
     """
@@ -16,163 +22,268 @@ def test_tracker_non_existing_configuration():
         assert "Cannot load a configuration, /path/non/exists/camera_matrix.data not found" in ex_info
 
 
-def test_tracker_with_marker(monkeypatch, mocked_cam):
+def test_tracker_binary_configuration(tmp_path):
+    """
+        The binary .npy calibration files should be preferred over the text ones
+    """
+    camera_matrix = np.loadtxt("../data/camera/test/camera_matrix.data")
+    camera_distortion = np.loadtxt("../data/camera/test/camera_distortion_coef.data")
+    np.save(tmp_path / "camera_matrix.npy", camera_matrix)
+    np.save(tmp_path / "camera_distortion_coef.npy", camera_distortion)
+
+    t = SingleMarkerTracker(0, 14.0, calibration_folder=str(tmp_path), debug=False)
+    try:
+        assert np.array_equal(t._camera_matrix, camera_matrix)
+        assert np.array_equal(t._camera_distortion.ravel(), camera_distortion)
+    finally:
+        t.stop()
+
+
+def test_tracker_with_marker(monkeypatch, mocked_cam, tracker):
     """
         The track method should return a LandingMarker object if the marker is present
     """
-    t = SingleMarkerTracker(0, 14.0, calibration_folder="../data/camera/test", debug=False)
-    monkeypatch.setattr(t, "_cam", mocked_cam("../data/camera/test/images/dark_far_center.jpg"))
+    monkeypatch.setattr(tracker, "_cam", mocked_cam("../data/camera/test/images/dark_far_center.jpg"))
 
-    result = t.track()
-    assert type(result) == LandingMarker
+    result = tracker.track()
+    assert isinstance(result, LandingMarker)
 
 
-def test_tracker_x_estimation(monkeypatch, mocked_cam):
+@pytest.mark.parametrize("smaller_image,greater_image,axis", [
+    # The more right the marker is, the greater the x should be
+    ("light_close_left.jpg", "light_close_right.jpg", "x"),
+    # When the marker is at the top the Y should be negative. When is at the bottom, Y should be positive
+    ("paper_close_top.jpg", "paper_far_bottom.jpg", "y"),
+    # The more the marker is far from the camera, the greater the z should be
+    ("paper_close_top.jpg", "paper_far_bottom.jpg", "z"),
+])
+def test_tracker_axis_estimation(monkeypatch, mocked_cam, tracker, smaller_image, greater_image, axis):
     """
-        The more right the marker is, the greater the x should be
+        The estimated position should follow the marker along each axis
     """
-    t = SingleMarkerTracker(0, 14.0, calibration_folder="../data/camera/test", debug=False)
-    monkeypatch.setattr(t, "_cam", mocked_cam("../data/camera/test/images/light_close_right.jpg"))
-    right_marker = t.track()
+    monkeypatch.setattr(tracker, "_cam", mocked_cam(f"../data/camera/test/images/{smaller_image}"))
+    smaller_marker = tracker.track()
 
-    monkeypatch.setattr(t, "_cam", mocked_cam("../data/camera/test/images/light_close_left.jpg"))
-    left_marker = t.track()
+    monkeypatch.setattr(tracker, "_cam", mocked_cam(f"../data/camera/test/images/{greater_image}"))
+    greater_marker = tracker.track()
 
-    assert right_marker.x > left_marker.x
+    assert getattr(smaller_marker, axis) < getattr(greater_marker, axis)
 
 
-def test_tracker_y_estimation(monkeypatch, mocked_cam):
+def test_tracker_without_marker(monkeypatch, mocked_cam, tracker):
     """
-        When the marker is at the top the Y should be negative. When is at the bottom, Y should be positive
+        The track method should return None if the marker is not present
     """
-    t = SingleMarkerTracker(0, 14.0, calibration_folder="../data/camera/test", debug=False)
-    monkeypatch.setattr(t, "_cam", mocked_cam("../data/camera/test/images/paper_close_top.jpg"))
-    top_marker = t.track()
+    monkeypatch.setattr(tracker, "_cam", mocked_cam("../data/camera/test/images/dark_no_marker.jpg"))
+
+    result = tracker.track()
+    assert result is None
 
-    monkeypatch.setattr(t, "_cam", mocked_cam("../data/camera/test/images/paper_far_bottom.jpg"))
-    bottom_marker = t.track()
 
-    assert top_marker.y < bottom_marker.y
+def _marker_frame(center_x, center_y, side=80, marker_id=0):
+    """White 640x480 BGR frame with a single marker of the tracker dictionary"""
+    dictionary = cv.aruco.getPredefinedDictionary(cv.aruco.DICT_4X4_250)
+    draw_marker = getattr(cv.aruco, "generateImageMarker", None) or cv.aruco.drawMarker  # OpenCV >= 4.7
+    frame = np.full((480, 640, 3), 255, dtype=np.uint8)
+    x0, y0 = center_x - side // 2, center_y - side // 2
+    frame[y0:y0 + side, x0:x0 + side] = cv.cvtColor(draw_marker(dictionary, marker_id, side), cv.COLOR_GRAY2BGR)
+    return frame
 
 
-def test_tracker_z_estimation(monkeypatch, mocked_cam):
+def test_tracker_search_region_same_pose(monkeypatch, frame_cam, tracker):
     """
-        The more the marker is far from the camera, the greater the z should be
+        The marker found in the search region should have the same pose as in the whole frame
     """
-    t = SingleMarkerTracker(0, 14.0, calibration_folder="../data/camera/test", debug=False)
-    monkeypatch.setattr(t, "_cam", mocked_cam("../data/camera/test/images/paper_close_top.jpg"))
-    close_marker = t.track()
+    monkeypatch.setattr(tracker, "_cam", frame_cam(_marker_frame(330, 250)))
+    full_frame_marker = tracker.track()
+    assert tracker._last_bbox is not None
 
-    monkeypatch.setattr(t, "_cam", mocked_cam("../data/camera/test/images/paper_far_bottom.jpg"))
-    far_marker = t.track()
+    roi_marker = tracker.track()
+    # Exact without Aruco3, which downscales the region and the whole frame differently (OpenCV >= 4.6)
+    assert (roi_marker.x, roi_marker.y, roi_marker.z) == approx(
+        (full_frame_marker.x, full_frame_marker.y, full_frame_marker.z), rel=0.02)
 
-    assert close_marker.z < far_marker.z
 
+def test_tracker_search_region_clipped(monkeypatch, frame_cam, tracker):
+    """
+        The search region of a marker at the edge of the frame should stay inside the frame
+    """
+    monkeypatch.setattr(tracker, "_cam", frame_cam(_marker_frame(40, 440, side=60)))
+    assert tracker.track() is not None
 
-def test_tracker_without_marker(monkeypatch, mocked_cam):
+    x, y, w, h = tracker._last_bbox
+    assert x == 0
+    assert y + h == 480
+    assert w < 2 * 60 and h < 2 * 60
+
+
+def test_tracker_search_region_min_side():
     """
-        The track method should return None if the marker is not present
+        The search region should not be smaller than min_side, even for tiny markers
     """
-    t = SingleMarkerTracker(0, 14.0, calibration_folder="../data/camera/test", debug=False)
-    monkeypatch.setattr(t, "_cam", mocked_cam("../data/camera/test/images/dark_no_marker.jpg"))
+    corners = np.array([[[300, 200], [304, 200], [304, 204], [300, 204]]], dtype=np.float32)
+    x, y, w, h = SingleMarkerTracker._get_search_region(corners, (480, 640), min_side=64)
+    assert w >= 64 and h >= 64
+    assert x <= 300 and x + w >= 304
 
-    result = t.track()
-    assert result is None
+
+def test_tracker_search_region_fallback(monkeypatch, frame_cam, tracker):
+    """
+        A marker that left the search region should be found in the whole frame
+    """
+    monkeypatch.setattr(tracker, "_cam", frame_cam(_marker_frame(120, 120)))
+    assert tracker.track() is not None
+    first_bbox = tracker._last_bbox
+
+    monkeypatch.setattr(tracker, "_cam", frame_cam(_marker_frame(500, 360)))
+    assert tracker.track() is not None
+    assert tracker._last_bbox != first_bbox
+    x, y, w, h = tracker._last_bbox
+    assert x <= 500 <= x + w and y <= 360 <= y + h
+
+
+def test_tracker_search_region_cleared(monkeypatch, frame_cam, tracker):
+    """
+        The search region should be dropped when the landing marker is no longer visible
+    """
+    monkeypatch.setattr(tracker, "_cam", frame_cam(_marker_frame(320, 240)))
+    assert tracker.track() is not None
+    assert tracker._last_bbox is not None
+
+    monkeypatch.setattr(tracker, "_cam", frame_cam(_marker_frame(320, 240, marker_id=5)))
+    assert tracker.track() is None
+    assert tracker._last_bbox is None
+
+
+def test_tracker_yuyv_to_gray(monkeypatch, tracker):
+    """
+        The grayscale image of a packed YUYV frame should be its Y plane
+    """
+    gray = np.arange(480 * 640, dtype=np.uint32).reshape(480, 640).astype(np.uint8)
+    yuyv = np.empty((480, 640, 2), dtype=np.uint8)
+    yuyv[:, :, 0] = gray
+    yuyv[:, :, 1] = 128
+    monkeypatch.setattr(tracker, "_yuyv_capture", True)
+    monkeypatch.setattr(tracker, "_frame_width", 640, raising=False)
+    monkeypatch.setattr(tracker, "_frame_height", 480, raising=False)
+
+    # V4L2 hands the raw frame as a flat buffer
+    assert np.array_equal(tracker._to_gray(yuyv.reshape(1, -1)), gray)
+
+
+def test_tracker_yuyv_fallback(monkeypatch):
+    """
+        A camera without YUYV frames should be read as BGR
+    """
+    class MjpgCam:
+        def __init__(self):
+            self.properties = {
+                cv.CAP_PROP_FRAME_WIDTH: 640,
+                cv.CAP_PROP_FRAME_HEIGHT: 480,
+                cv.CAP_PROP_FOURCC: cv.VideoWriter_fourcc(*"MJPG"),
+            }
+
+        def get(self, prop):
+            return self.properties.get(prop, 0)
+
+        def set(self, prop, value):
+            self.properties[prop] = value
+
+        def release(self):
+            pass
+
+    cam = MjpgCam()
+    monkeypatch.setattr("precision_landing.tracker.open_video_capture", lambda *args, **kwargs: cam)
+
+    t = SingleMarkerTracker(0, 14.0, calibration_folder="../data/camera/test", yuyv_capture=True)
+    try:
+        assert t._yuyv_capture is False
+        assert cam.properties[cv.CAP_PROP_CONVERT_RGB] == 1
+    finally:
+        t.stop()
+
+
+def test_tracker_failed_pose_estimation(monkeypatch, tracker):
+    """
+        No LandingMarker should be returned if the pose of the marker cannot be estimated
+    """
+    monkeypatch.setattr(cv, "solvePnP", lambda *args, **kwargs: (False, np.zeros((3, 1)), np.zeros((3, 1))))
+    corners = np.array([[[0, 0], [10, 0], [10, 10], [0, 10]]], dtype=np.float32)
+
+    assert tracker._get_landing_marker(corners) is None
 
 
 def test_landing_marker():
-    lm = LandingMarker(x=0, y=0, z=0, rotations=np.zeros(1), translations=np.zeros(1))
+    lm = LandingMarker(x=0, y=0, z=0, rotations=_ZERO1, translations=_ZERO1)
 
     assert lm.x == 0
     assert lm.y == 0
     assert lm.z == 0
-    assert lm.rotations == np.zeros(1)
-    assert lm.translations == np.zeros(1)
+    assert lm.rotations == _ZERO1
+    assert lm.translations == _ZERO1
 
 
 def test_landing_marker_frame_ref_camera_to_uav():
-    lm = LandingMarker(x=10, y=5, z=0, rotations=np.zeros(1), translations=np.zeros(1))
+    lm = LandingMarker(x=10, y=5, z=0, rotations=_ZERO1, translations=_ZERO1)
 
     uav_position = lm.convert_reference_from_camera_to_uav()
     assert uav_position.x == -10
     assert uav_position.y == -5
 
 
-def test_landing_marker_estimate_angles_to_marker():
-    lm = LandingMarker(x=0, y=0, z=0, rotations=np.zeros(1), translations=np.zeros(1))
-
-    marker_angles = lm.estimate_angles_to_marker(uav_height=None)
-    assert type(marker_angles) == MarkerAngles
-
-    assert marker_angles.angle_x == 0
-    assert marker_angles.angle_y == 0
-
-    lm = LandingMarker(x=1, y=0, z=5, rotations=np.zeros(1), translations=np.zeros(1))
-    marker_angles = lm.estimate_angles_to_marker(uav_height=None)
-    assert round(marker_angles.angle_x, 2) == -0.2
-    assert marker_angles.angle_y == 0
+@pytest.mark.parametrize("x,y,z,uav_height,expected_angle_x,expected_angle_y,tolerance", [
+    (0, 0, 0, None, 0, 0, 0),
+    (1, 0, 5, None, -0.2, 0, 5e-3),
+    (0, 1, 5, None, 0, -0.2, 5e-3),
+    (1, 1, 1, None, -math.pi / 4, -math.pi / 4, 0),
+    # uav_height too low, using precise z from landing marker
+    (1, 1, 1, 3, -math.pi / 4, -math.pi / 4, 0),
+    # uav_height high, using uav_height
+    (100, 100, 1, 10, -0.1, -0.1, 5e-3),
+])
+def test_landing_marker_estimate_angles_to_marker(x, y, z, uav_height, expected_angle_x, expected_angle_y, tolerance):
+    """
+        The angles are compared within the given absolute tolerance, exactly when it is 0
+    """
+    lm = LandingMarker(x=x, y=y, z=z, rotations=_ZERO1, translations=_ZERO1)
 
-    lm = LandingMarker(x=0, y=1, z=5, rotations=np.zeros(1), translations=np.zeros(1))
-    marker_angles = lm.estimate_angles_to_marker(uav_height=None)
-    assert marker_angles.angle_x == 0
-    assert round(marker_angles.angle_y, 2) == -0.2
+    marker_angles = lm.estimate_angles_to_marker(uav_height=uav_height)
+    assert isinstance(marker_angles, MarkerAngles)
 
-    lm = LandingMarker(x=1, y=1, z=1, rotations=np.zeros(1), translations=np.zeros(1))
-    marker_angles = lm.estimate_angles_to_marker(uav_height=None)
-    assert marker_angles.angle_x == -math.pi/4
-    assert marker_angles.angle_y == -math.pi/4
+    assert marker_angles.angle_x == approx(expected_angle_x, abs=tolerance)
+    assert marker_angles.angle_y == approx(expected_angle_y, abs=tolerance)
 
-    # uav_height too low, using precise z from landing marker
-    lm = LandingMarker(x=1, y=1, z=1, rotations=np.zeros(1), translations=np.zeros(1))
-    marker_angles = lm.estimate_angles_to_marker(uav_height=3)
-    assert marker_angles.angle_x == -math.pi / 4
-    assert marker_angles.angle_y == -math.pi / 4
 
-    # uav_height high, using uav_height
-    lm = LandingMarker(x=100, y=100, z=1, rotations=np.zeros(1), translations=np.zeros(1))
-    marker_angles = lm.estimate_angles_to_marker(uav_height=10)
-    assert round(marker_angles.angle_x, 2) == -0.1
-    assert round(marker_angles.angle_y, 2) == -0.1
+@pytest.fixture
+def lm_factory():
+    def _landing_marker(x, y, z=1):
+        return LandingMarker(x=x, y=y, z=z, rotations=_ZERO1, translations=_ZERO1)
 
+    return _landing_marker
 
-def test_landing_marker_north_east_coordinates():
-    lm = LandingMarker(x=1, y=1, z=1, rotations=np.zeros(1), translations=np.zeros(1))
-    north, east = lm.get_north_east_directions_for_uav(0)
-    assert north == -1
-    assert east == -1
 
-    lm = LandingMarker(x=-1, y=1, z=1, rotations=np.zeros(1), translations=np.zeros(1))
-    north, east = lm.get_north_east_directions_for_uav(0)
-    assert north == 1
-    assert east == -1
+@pytest.mark.parametrize("x,y,heading,expected_north,expected_east,tolerance", [
+    (1, 1, 0, -1, -1, 0),
+    (-1, 1, 0, 1, -1, 0),
+    (1, -1, 0, -1, 1, 0),
+    (-1, 1, 315, 0, -1.4142, 5e-5),  # -45 deg
+])
+def test_landing_marker_north_east_coordinates(lm_factory, x, y, heading, expected_north, expected_east, tolerance):
+    north, east = lm_factory(x, y).get_north_east_directions_for_uav(heading)
+    assert north == approx(expected_north, abs=tolerance)
+    assert east == approx(expected_east, abs=tolerance)
 
-    lm = LandingMarker(x=1, y=-1, z=1, rotations=np.zeros(1), translations=np.zeros(1))
-    north, east = lm.get_north_east_directions_for_uav(0)
-    assert north == -1
-    assert east == 1
 
-    lm = LandingMarker(x=-1, y=1, z=1, rotations=np.zeros(1), translations=np.zeros(1))
-    north, east = lm.get_north_east_directions_for_uav(315)  # -45 deg
-    assert north < 1e-6
-    assert round(east, 4) == -1.4142
+def _get_coordinates_batch(lm, original_position, headings):
+    """Latitudes and longitudes returned by get_coordinates for every heading"""
+    coordinates = np.array([lm.get_coordinates(original_position, heading) for heading in headings])
+    return coordinates[:, 0], coordinates[:, 1]
 
 
 def test_landing_marker_get_coordinates():
-    lm = LandingMarker(x=-1, y=-1, z=1, rotations=np.zeros(1), translations=np.zeros(1))
+    lm = LandingMarker(x=-1, y=-1, z=1, rotations=_ZERO1, translations=_ZERO1)
     original_position = Position(latitude_deg=45, longitude_deg=8, absolute_altitude_m=100, relative_altitude_m=10)
 
-    lat, lon = lm.get_coordinates(original_position, 90)
-    assert round(lat, 6) == 44.999991
-    assert round(lon, 6) == 8.000013
-
-    lat, lon = lm.get_coordinates(original_position, 0)
-    assert round(lat, 6) == 45.000009
-    assert round(lon, 6) == 8.000013
-
-    lat, lon = lm.get_coordinates(original_position, 180)
-    assert round(lat, 6) == 44.999991
-    assert round(lon, 6) == 7.999987
-
-    lat, lon = lm.get_coordinates(original_position, 270)
-    assert round(lat, 6) == 45.000009
-    assert round(lon, 6) == 7.999987
+    lat, lon = _get_coordinates_batch(lm, original_position, [90, 0, 180, 270])
+    np.testing.assert_allclose(lat, [44.999991, 45.000009, 44.999991, 45.000009], rtol=0, atol=5e-7)
+    np.testing.assert_allclose(lon, [8.000013, 8.000013, 7.999987, 7.999987], rtol=0, atol=5e-7)
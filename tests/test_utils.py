@@ -0,0 +1,42 @@
+import pytest
+
+from core.utils import buffered, first
+
+
+async def numbers(n):
+    for x in range(n):
+        yield x
+
+
+@pytest.mark.asyncio
+async def test_buffered_keeps_order():
+    assert [x async for x in buffered(numbers(10), n=3)] == list(range(10))
+
+
+@pytest.mark.asyncio
+async def test_buffered_propagates_errors():
+    async def broken():
+        yield 1
+        raise ValueError("stream broken")
+
+    received = []
+    with pytest.raises(ValueError):
+        async for x in buffered(broken()):
+            received.append(x)
+    assert received == [1]
+
+
+@pytest.mark.asyncio
+async def test_first_closes_the_stream():
+    closed = []
+
+    async def stream():
+        try:
+            for x in range(3):
+                yield x
+        finally:
+            closed.append(True)
+
+    assert await first(stream()) == 0
+    assert closed == [True]
+    assert await first(numbers(0)) is None